@@ -3,17 +3,21 @@ FastAPI backend service for AI chatbot.
 Handles conversation, entity extraction, and workflow orchestration.
 """
 import os
+import asyncio
+import functools
 import logging
+import re
 import uuid
-from datetime import datetime
 from typing import Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from google.cloud.run_v2 import JobsClient, RunJobRequest
+from google.cloud import firestore
 from dotenv import load_dotenv
 
-from vertex_ai import VertexAIExtractor
+from vertex_ai import BatchingExtractor, VertexAIExtractor, local_extract
 from state_manager import StateManager
 from pubsub_publisher import PubSubPublisher
 
@@ -32,6 +36,9 @@ app = FastAPI(
     title="Dataset Chatbot API",
     description="AI-powered chatbot for creating BigQuery dataset PRs",
     version="1.0.0",
+    # orjson encodes responses (incl. datetimes/UUIDs) in Rust instead of
+    # going through json.dumps with per-field Python callbacks
+    default_response_class=ORJSONResponse,
 )
 
 # Add CORS middleware
@@ -44,10 +51,17 @@ app.add_middleware(
 )
 
 # Initialize services
-vertex_extractor = VertexAIExtractor()
+vertex_extractor = BatchingExtractor(VertexAIExtractor())
 state_manager = StateManager()
 pubsub_publisher = PubSubPublisher()
 
+# Reuse one Jobs client (and its gRPC channel/auth) across requests instead
+# of paying channel setup on every chat turn
+jobs_client = JobsClient()
+PROJECT_ID = os.getenv("PROJECT_ID", "helpful-charmer-485315-j7")
+REGION = os.getenv("REGION", "us-central1")
+JOB_NAME = f"projects/{PROJECT_ID}/locations/{REGION}/jobs/git-worker"
+
 # ===== Request/Response Models =====
 
 
@@ -80,38 +94,118 @@ class StatusResponse(BaseModel):
     error: Optional[str] = None
 
 
+# Fields a dataset request must provide before dispatching to the worker
+REQUIRED_FIELDS = ("dataset_name", "location", "labels", "service_account")
+
+
 # ===== Helper Functions =====
 
+# Matches one "key:value" or "key=value" pair, tolerating whitespace around
+# the separator and trailing the value, up to the next comma
+_LABEL_RE = re.compile(r"\s*([^:=,\s]+)\s*[:=]\s*([^,]*?)\s*(?=,|$)")
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_labels_cached(labels_str: str) -> tuple:
+    """Parse once per distinct string; returns hashable items for the cache."""
+    return tuple((m.group(1), m.group(2)) for m in _LABEL_RE.finditer(labels_str))
+
+
+def _render_entity(value) -> str:
+    """Render an extracted entity for display (dicts as 'k:v, k2:v2')."""
+    if isinstance(value, dict):
+        return ", ".join(f"{k}:{v}" for k, v in value.items())
+    return str(value)
+
+
 def parse_labels(labels_str: str) -> dict:
     """
     Parse labels string into dictionary.
     Supports formats: 'key:value,key2:value2' or 'key=value,key2=value2'
+
+    Parsing is pure and the same merged string recurs on every turn of a
+    session, so results are memoized.
     """
     if not labels_str:
         return {}
-    
-    labels_dict = {}
+    return dict(_parse_labels_cached(labels_str))
+
+
+async def _publish_and_trigger(
+    request_id: str,
+    session_id: str,
+    dataset_name: str,
+    location: str,
+    labels: dict,
+    service_account: str,
+):
+    """
+    Publish the dataset request to Pub/Sub and trigger the worker job.
+
+    Runs as a background task after the HTTP response is sent, so the user
+    doesn't wait on the Cloud Run Admin API or the publish round-trip.
+    Failures are logged and reflected in the PR request status - including
+    delivery failures reported later by the publish future, since by then
+    the user has already been told the PR is coming.
+    """
+    loop = asyncio.get_running_loop()
+
+    def _mark_failed(exc: Exception):
+        # Runs on the publisher's callback thread; hop back onto the event
+        # loop to use the async Firestore client
+        asyncio.run_coroutine_threadsafe(
+            state_manager.update_pr_request_status(
+                request_id=request_id,
+                status="failed",
+                error=f"Pub/Sub delivery failed: {exc}",
+            ),
+            loop,
+        )
+
+    publish_success = await pubsub_publisher.publish_dataset_request(
+        request_id=request_id,
+        session_id=session_id,
+        dataset_name=dataset_name,
+        location=location,
+        labels=labels,
+        service_account=service_account,
+        on_failure=_mark_failed,
+    )
+
+    if not publish_success:
+        await state_manager.update_pr_request_status(
+            request_id=request_id,
+            status="failed",
+            error="Failed to publish request to Pub/Sub",
+        )
+        return
+
+    # Trigger the Cloud Run Job immediately for instant processing
     try:
-        # Split by comma and parse key:value or key=value pairs
-        pairs = [pair.strip() for pair in labels_str.split(',')]
-        for pair in pairs:
-            if ':' in pair:
-                key, value = pair.split(':', 1)
-            elif '=' in pair:
-                key, value = pair.split('=', 1)
-            else:
-                continue  # Skip invalid pairs
-            
-            labels_dict[key.strip()] = value.strip()
+        # Trigger the job (async - don't wait for completion)
+        await asyncio.to_thread(jobs_client.run_job, request=RunJobRequest(name=JOB_NAME))
+        logger.info(f"Triggered Cloud Run Job: {JOB_NAME}")
+
     except Exception as e:
-        logger.warning(f"Error parsing labels: {e}")
-    
-    return labels_dict
+        # Log error but don't fail - Pub/Sub message is already queued
+        # Scheduler will still pick it up as backup
+        logger.error(f"Failed to trigger job directly: {e}", exc_info=True)
 
 
 # ===== Endpoints =====
 
 
+@app.on_event("startup")
+async def warmup():
+    """Warm the Vertex AI channel so the first user doesn't pay cold-start."""
+    try:
+        await vertex_extractor.warmup()
+        logger.info("Vertex AI model warmed up")
+    except Exception as e:
+        # Startup must still succeed; the first request just pays the cost
+        logger.warning(f"Vertex AI warmup failed: {e}")
+
+
 @app.get("/")
 async def root():
     """Health check endpoint."""
@@ -123,7 +217,7 @@ async def root():
 
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, background_tasks: BackgroundTasks):
     """
     Main chat endpoint. Handles conversation and entity extraction.
     
@@ -140,45 +234,70 @@ async def chat(request: ChatRequest):
         
         logger.info(f"Processing chat request for session: {session_id}")
         
-        # Get conversation state
-        conversation_state = state_manager.get_conversation_state(session_id)
-        
+        # Get conversation state once; reuse the cached dict for the whole turn
+        doc_ref, conversation_state = await state_manager.get_state_cached(session_id)
+
         # Check if previous conversation was completed - if so, start fresh
         if conversation_state.get("status") == "completed":
             logger.info(f"Previous conversation completed. Starting new conversation for session {session_id}")
             # Reset the conversation state for a new dataset request
-            doc_ref = state_manager.conversations_collection.document(session_id)
-            doc_ref.update({
+            await doc_ref.update({
                 "status": "in_progress",
                 "extracted_entities": {},
-                "updated_at": datetime.utcnow(),
+                "updated_at": firestore.SERVER_TIMESTAMP,
             })
-            # Get the fresh state
-            conversation_state = state_manager.get_conversation_state(session_id)
-        
+            # Mirror the reset locally instead of re-reading the document
+            conversation_state["status"] = "in_progress"
+            conversation_state["extracted_entities"] = {}
+
         conversation_history = conversation_state.get("messages", [])
-        
+
+        # Stage all Firestore writes for this turn and commit them as one RPC
+        batch = state_manager.batch()
+
+        # When >=3 of 4 fields are already collected, try the cheap regex
+        # extractor first - a user supplying the last value (or just
+        # confirming) shouldn't cost a full Gemini round-trip
+        existing_entities = conversation_state.get("extracted_entities", {})
+        missing_before = [
+            field for field in REQUIRED_FIELDS
+            if not existing_entities.get(field)
+        ]
+
+        extraction_result = None
+        if len(missing_before) == 1:
+            local_entities = local_extract(request.message, missing_before)
+            if all(local_entities.get(field) for field in missing_before):
+                logger.info(f"Locally extracted {missing_before} without model call")
+                extraction_result = {"success": True, "entities": local_entities}
+
         # Extract entities from user message
-        extraction_result = vertex_extractor.extract_entities(
-            request.message,
-            conversation_history
-        )
-        
+        if extraction_result is None:
+            extraction_result = await vertex_extractor.extract_entities(
+                request.message,
+                conversation_history
+            )
+
         if not extraction_result.get("success"):
             # Extraction failed, ask user to rephrase
             error_message = "I'm having trouble understanding. Could you please rephrase that?"
             
-            state_manager.update_conversation_state(
+            await state_manager.update_conversation_state(
                 session_id,
                 request.message,
-                role="user"
+                role="user",
+                current_state=conversation_state,
+                batch=batch,
             )
-            state_manager.update_conversation_state(
+            await state_manager.update_conversation_state(
                 session_id,
                 error_message,
-                role="assistant"
+                role="assistant",
+                current_state=conversation_state,
+                batch=batch,
             )
-            
+            await batch.commit()
+
             return ChatResponse(
                 message=error_message,
                 session_id=session_id,
@@ -187,48 +306,46 @@ async def chat(request: ChatRequest):
         
         # Update conversation with extracted entities
         new_entities = extraction_result.get("entities", {})
-        state_manager.update_conversation_state(
+        await state_manager.update_conversation_state(
             session_id,
             request.message,
             role="user",
-            extracted_entities=new_entities
+            extracted_entities=new_entities,
+            current_state=conversation_state,
+            batch=batch,
         )
-        
-        # Get updated state with merged entities
-        updated_state = state_manager.get_conversation_state(session_id)
-        all_entities = updated_state.get("extracted_entities", {})
 
-        
-        # Check for required fields
-        required_fields = ["dataset_name", "location", "labels", "service_account"]
-        missing_fields = [
-            field for field in required_fields
-            if not all_entities.get(field)
-        ]
-        
+        # The cached state now holds the merged entities - no re-read needed
+        all_entities = conversation_state.get("extracted_entities", {})
+
+
+        # Partition required fields into missing/collected in one pass
+        missing_fields, collected = [], []
+        for field in REQUIRED_FIELDS:
+            (collected if all_entities.get(field) else missing_fields).append(field)
+
         if missing_fields:
             # Still collecting information
             follow_up = vertex_extractor.generate_follow_up_question(missing_fields)
-            
+
             # Show what we have so far
-            collected = [field for field in required_fields if all_entities.get(field)]
             if collected:
-                status_msg = "Great! I've collected:\\n"
+                lines = ["Great! I've collected:"]
                 for field in collected:
-                    value = all_entities[field]
-                    if isinstance(value, dict):
-                        value = ", ".join([f"{k}:{v}" for k, v in value.items()])
-                    status_msg += f"✓ {field}: {value}\\n"
-                status_msg += f"\\n{follow_up}"
+                    lines.append(f"✓ {field}: {_render_entity(all_entities[field])}")
+                status_msg = "\\n".join(lines) + f"\\n\\n{follow_up}"
             else:
                 status_msg = f"I can help you create a BigQuery dataset! {follow_up}"
             
-            state_manager.update_conversation_state(
+            await state_manager.update_conversation_state(
                 session_id,
                 status_msg,
-                role="assistant"
+                role="assistant",
+                current_state=conversation_state,
+                batch=batch,
             )
-            
+            await batch.commit()
+
             return ChatResponse(
                 message=status_msg,
                 session_id=session_id,
@@ -243,7 +360,7 @@ async def chat(request: ChatRequest):
         labels_dict = parse_labels(all_entities["labels"]) if isinstance(all_entities["labels"], str) else all_entities["labels"]
         
         # Create PR request record
-        state_manager.create_pr_request(
+        await state_manager.create_pr_request(
             request_id=request_id,
             session_id=session_id,
             payload={
@@ -251,47 +368,12 @@ async def chat(request: ChatRequest):
                 "location": all_entities["location"],
                 "labels": labels_dict,
                 "service_account": all_entities["service_account"],
-            }
-        )
-        
-        # Publish to Pub/Sub
-        publish_success = pubsub_publisher.publish_dataset_request(
-            request_id=request_id,
-            session_id=session_id,
-            dataset_name=all_entities["dataset_name"],
-            location=all_entities["location"],
-            labels=labels_dict,
-            service_account=all_entities["service_account"],
+            },
+            batch=batch,
         )
-        
-        if not publish_success:
-            error_msg = "Sorry, I encountered an error while creating your request. Please try again."
-            return ChatResponse(
-                message=error_msg,
-                session_id=session_id,
-                status="error",
-            )
-        
-        # Trigger the Cloud Run Job immediately for instant processing
-        try:
-            project_id = os.getenv("PROJECT_ID", "helpful-charmer-485315-j7")
-            region = os.getenv("REGION", "us-central1")
-            job_name = f"projects/{project_id}/locations/{region}/jobs/git-worker"
-            
-            jobs_client = JobsClient()
-            request = RunJobRequest(name=job_name)
-            
-            # Trigger the job (async - don't wait for completion)
-            operation = jobs_client.run_job(request=request)
-            logger.info(f"Triggered Cloud Run Job: {job_name}")
-            
-        except Exception as e:
-            # Log error but don't fail the request - Pub/Sub message is already queued
-            # Scheduler will still pick it up as backup
-            logger.error(f"Failed to trigger job directly: {e}", exc_info=True)
-        
+
         # Mark conversation as complete
-        state_manager.mark_conversation_complete(session_id, request_id)
+        await state_manager.mark_conversation_complete(session_id, request_id, batch=batch)
         
         completion_message = (
             f"✅ Perfect! I have all the information I need.\n\n"
@@ -301,12 +383,27 @@ async def chat(request: ChatRequest):
             f"I'll update you once the PR is created!"
         )
         
-        state_manager.update_conversation_state(
+        await state_manager.update_conversation_state(
             session_id,
             completion_message,
-            role="assistant"
+            role="assistant",
+            current_state=conversation_state,
+            batch=batch,
         )
-        
+        await batch.commit()
+
+        # Publish to Pub/Sub and trigger the worker after the response is
+        # sent - the user only needs to know the request was accepted
+        background_tasks.add_task(
+            _publish_and_trigger,
+            request_id=request_id,
+            session_id=session_id,
+            dataset_name=all_entities["dataset_name"],
+            location=all_entities["location"],
+            labels=labels_dict,
+            service_account=all_entities["service_account"],
+        )
+
         return ChatResponse(
             message=completion_message,
             session_id=session_id,
@@ -328,7 +425,7 @@ async def get_status(request_id: str):
     The frontend now uses Firestore real-time listeners for instant status updates.
     """
     try:
-        pr_request = state_manager.get_pr_request(request_id)
+        pr_request = await state_manager.get_pr_request(request_id)
         
         if not pr_request:
             raise HTTPException(status_code=404, detail="Request not found")
@@ -356,7 +453,7 @@ async def pr_ready_webhook(request_id: str, pr_url: str, status: str = "complete
     try:
         logger.info(f"Received webhook for request {request_id}: {status}")
         
-        state_manager.update_pr_request_status(
+        await state_manager.update_pr_request_status(
             request_id=request_id,
             status=status,
             pr_url=pr_url if status == "completed" else None,
@@ -2,9 +2,9 @@
 Pub/Sub publisher for dispatching complete dataset requests to the worker.
 """
 import os
-import json
 import logging
 from typing import Dict, Any
+import orjson
 from google.cloud import pubsub_v1
 
 logger = logging.getLogger(__name__)
@@ -17,11 +17,19 @@ class PubSubPublisher:
     """Publishes messages to Cloud Pub/Sub."""
 
     def __init__(self):
-        self.publisher = pubsub_v1.PublisherClient()
+        # Let the client-side batcher coalesce messages published within a
+        # short window into one RPC instead of blocking per publish
+        self.publisher = pubsub_v1.PublisherClient(
+            batch_settings=pubsub_v1.types.BatchSettings(
+                max_messages=100,
+                max_bytes=1_000_000,
+                max_latency=0.05,
+            )
+        )
         self.topic_path = self.publisher.topic_path(PROJECT_ID, TOPIC_NAME)
         logger.info(f"Initialized Pub/Sub publisher for topic: {self.topic_path}")
 
-    def publish_dataset_request(
+    async def publish_dataset_request(
         self,
         request_id: str,
         dataset_name: str,
@@ -29,6 +37,7 @@ class PubSubPublisher:
         labels: Dict[str, str],
         service_account: str,
         session_id: str = None,
+        on_failure=None,
     ) -> bool:
         """
         Publish a complete dataset request to Pub/Sub.
@@ -40,9 +49,14 @@ class PubSubPublisher:
             labels: Dict of labels
             service_account: Service account email
             session_id: Session ID for tracking
+            on_failure: Called with the exception (from the publisher's
+                callback thread) if delivery ultimately fails after the
+                publish was accepted
 
         Returns:
-            True if published successfully, False otherwise
+            True if the publish was accepted by the client-side batcher,
+            False if it could not be scheduled. Delivery is confirmed (or
+            on_failure invoked) asynchronously via the future's callback.
         """
         try:
             payload = {
@@ -54,8 +68,9 @@ class PubSubPublisher:
                 "service_account": service_account,
             }
 
-            # Convert to JSON bytes
-            message_data = json.dumps(payload).encode("utf-8")
+            # Convert to JSON bytes (orjson emits bytes directly - no
+            # intermediate str allocation)
+            message_data = orjson.dumps(payload)
 
             # Publish with attributes for filtering/routing
             future = self.publisher.publish(
@@ -65,12 +80,28 @@ class PubSubPublisher:
                 dataset_name=dataset_name,
             )
 
-            # Wait for publish to complete
-            message_id = future.result(timeout=10)
-            
-            logger.info(
-                f"Published request {request_id} to Pub/Sub. Message ID: {message_id}"
-            )
+            # Don't block on the result - waiting here would defeat the
+            # batcher. Log the outcome from the future's callback instead.
+            def _on_publish_done(f):
+                try:
+                    message_id = f.result()
+                    logger.info(
+                        f"Published request {request_id} to Pub/Sub. Message ID: {message_id}"
+                    )
+                except Exception as e:
+                    logger.error(
+                        f"Publish of request {request_id} failed: {e}", exc_info=True
+                    )
+                    if on_failure is not None:
+                        try:
+                            on_failure(e)
+                        except Exception:
+                            logger.error(
+                                f"on_failure handler for request {request_id} raised",
+                                exc_info=True,
+                            )
+
+            future.add_done_callback(_on_publish_done)
             return True
 
         except Exception as e:
@@ -4,7 +4,9 @@ State management using Firestore for conversation and request tracking.
 import os
 import logging
 from typing import Dict, Optional, Any
-from datetime import datetime
+from datetime import datetime, timezone
+from cachetools import TTLCache
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 
 logger = logging.getLogger(__name__)
@@ -12,83 +14,146 @@ logger = logging.getLogger(__name__)
 PROJECT_ID = os.getenv("PROJECT_ID", "helpful-charmer-485315-j7")
 FIRESTORE_DB = os.getenv("FIRESTORE_DATABASE", "(default)")
 
+# Cap the in-document message history. ArrayUnion appends grow the document
+# without bound (and each server-side union is O(n)); keeping only the most
+# recent turns bounds write cost and keeps us clear of the 1 MiB doc limit.
+MAX_HISTORY = int(os.getenv("MAX_HISTORY_MESSAGES", "20"))
+
 
 class StateManager:
     """Manages conversation state and request tracking in Firestore."""
 
     def __init__(self):
-        self.db = firestore.Client(project=PROJECT_ID, database=FIRESTORE_DB)
+        self.db = firestore.AsyncClient(project=PROJECT_ID, database=FIRESTORE_DB)
         self.conversations_collection = self.db.collection("conversations")
         self.requests_collection = self.db.collection("pr_requests")
+        # PR status transitions only a few times over its lifetime while
+        # polling clients read it in bursts; a tiny TTL cache collapses a
+        # burst of /status polls into one Firestore read
+        self._pr_cache = TTLCache(maxsize=10_000, ttl=2.0)
+
+    def batch(self):
+        """
+        Create a Firestore WriteBatch.
+
+        Callers can pass the batch into the write methods below to stage all
+        writes for one chat turn and commit them as a single RPC.
+        """
+        return self.db.batch()
 
     # ===== Conversation State Management =====
 
-    def get_conversation_state(self, session_id: str) -> Dict[str, Any]:
+    async def get_conversation_state(self, session_id: str) -> Dict[str, Any]:
         """Retrieve conversation state for a session."""
+        return (await self.get_state_cached(session_id))[1]
+
+    async def get_state_cached(self, session_id: str):
+        """
+        Retrieve conversation state once, returning (doc_ref, state_dict).
+
+        Callers that need to issue several reads/writes in one request should
+        fetch the state here a single time and pass it back into
+        update_conversation_state via current_state, avoiding redundant
+        Firestore round-trips.
+        """
+        doc_ref = self.conversations_collection.document(session_id)
         try:
-            doc_ref = self.conversations_collection.document(session_id)
-            doc = doc_ref.get()
+            doc = await doc_ref.get()
 
             if doc.exists:
-                return doc.to_dict()
-            else:
-                # Initialize new conversation
-                initial_state = {
-                    "session_id": session_id,
-                    "created_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow(),
-                    "messages": [],
-                    "extracted_entities": {},
-                    "status": "in_progress",
-                }
-                doc_ref.set(initial_state)
-                return initial_state
+                return doc_ref, doc.to_dict()
+
+            # Initialize new conversation. create() (rather than set()) fails
+            # server-side if a concurrent request initialized the session in
+            # the window since our read, so the two writers can't clobber
+            # each other.
+            initial_state = {
+                "session_id": session_id,
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "updated_at": firestore.SERVER_TIMESTAMP,
+                "messages": [],
+                "extracted_entities": {},
+                "status": "in_progress",
+            }
+            try:
+                await doc_ref.create(initial_state)
+                return doc_ref, initial_state
+            except AlreadyExists:
+                # Lost the race - use the state the other request wrote
+                doc = await doc_ref.get()
+                return doc_ref, doc.to_dict()
 
         except Exception as e:
             logger.error(f"Error getting conversation state: {e}", exc_info=True)
-            return {
+            return doc_ref, {
                 "session_id": session_id,
                 "messages": [],
                 "extracted_entities": {},
                 "status": "error",
             }
 
-    def update_conversation_state(
+    async def update_conversation_state(
         self,
         session_id: str,
         message: str,
         role: str = "user",
         extracted_entities: Dict = None,
+        current_state: Dict = None,
+        batch=None,
     ) -> bool:
-        """Update conversation state with new message and entities."""
+        """
+        Update conversation state with new message and entities.
+
+        If current_state (from get_state_cached) is provided, entities are
+        merged against it locally instead of re-reading the document, and the
+        dict is mutated in place so the caller sees the merged result.
+
+        If batch (from batch()) is provided, the write is staged on it
+        instead of being sent immediately; the caller commits once per turn.
+        """
         try:
             doc_ref = self.conversations_collection.document(session_id)
 
-            # Add message to history
+            # SERVER_TIMESTAMP sentinels aren't allowed inside arrays, so
+            # message timestamps stay client-side (timezone-aware)
             new_message = {
                 "role": role,
                 "content": message,
-                "timestamp": datetime.utcnow(),
+                "timestamp": datetime.now(timezone.utc),
             }
 
+            if current_state is not None:
+                # Keep only the most recent turns so the document (and each
+                # write) stays bounded
+                messages = current_state.setdefault("messages", [])
+                messages.append(new_message)
+                if len(messages) > MAX_HISTORY:
+                    del messages[:-MAX_HISTORY]  # trim in place so cached state stays bounded
+                messages_value = list(messages)
+            else:
+                # No cached copy: append server-side instead of paying a
+                # read just to rewrite the list
+                messages_value = firestore.ArrayUnion([new_message])
+
             update_data = {
-                "messages": firestore.ArrayUnion([new_message]),
-                "updated_at": datetime.utcnow(),
+                "messages": messages_value,
+                "updated_at": firestore.SERVER_TIMESTAMP,
             }
 
-            # Merge extracted entities
+            # Send only the non-empty entity fields; set(merge=True) merges
+            # them into the stored map server-side, so no prior read is
+            # needed to preserve the other keys
             if extracted_entities:
-                current_state = self.get_conversation_state(session_id)
-                merged_entities = current_state.get("extracted_entities", {})
-                
-                # Update only non-empty fields
-                for key, value in extracted_entities.items():
-                    if value:  # Only update if value is not None or empty
-                        merged_entities[key] = value
-                
-                update_data["extracted_entities"] = merged_entities
-
-            doc_ref.update(update_data)
+                entity_patch = {k: v for k, v in extracted_entities.items() if v}
+                if entity_patch:
+                    update_data["extracted_entities"] = entity_patch
+                    if current_state is not None:
+                        current_state.setdefault("extracted_entities", {}).update(entity_patch)
+
+            if batch is not None:
+                batch.set(doc_ref, update_data, merge=True)
+            else:
+                await doc_ref.set(update_data, merge=True)
             logger.info(f"Updated conversation state for session {session_id}")
             return True
 
@@ -96,21 +161,25 @@ class StateManager:
             logger.error(f"Error updating conversation state: {e}", exc_info=True)
             return False
 
-    def get_conversation_history(self, session_id: str, limit: int = 10) -> list:
+    async def get_conversation_history(self, session_id: str, limit: int = 10) -> list:
         """Get recent conversation messages."""
-        state = self.get_conversation_state(session_id)
+        state = await self.get_conversation_state(session_id)
         messages = state.get("messages", [])
         return messages[-limit:]  # Return last N messages
 
-    def mark_conversation_complete(self, session_id: str, request_id: str) -> bool:
+    async def mark_conversation_complete(self, session_id: str, request_id: str, batch=None) -> bool:
         """Mark conversation as complete and link to PR request."""
         try:
             doc_ref = self.conversations_collection.document(session_id)
-            doc_ref.update({
+            update_data = {
                 "status": "completed",
                 "request_id": request_id,
-                "completed_at": datetime.utcnow(),
-            })
+                "completed_at": firestore.SERVER_TIMESTAMP,
+            }
+            if batch is not None:
+                batch.update(doc_ref, update_data)
+            else:
+                await doc_ref.update(update_data)
             return True
         except Exception as e:
             logger.error(f"Error marking conversation complete: {e}", exc_info=True)
@@ -118,26 +187,30 @@ class StateManager:
 
     # ===== PR Request Tracking =====
 
-    def create_pr_request(
+    async def create_pr_request(
         self,
         request_id: str,
         session_id: str,
         payload: Dict[str, Any],
+        batch=None,
     ) -> bool:
         """Create a new PR request record."""
         try:
             doc_ref = self.requests_collection.document(request_id)
-            
+
             request_data = {
                 "request_id": request_id,
                 "session_id": session_id,
                 "payload": payload,
                 "status": "pending",
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow(),
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "updated_at": firestore.SERVER_TIMESTAMP,
             }
-            
-            doc_ref.set(request_data)
+
+            if batch is not None:
+                batch.set(doc_ref, request_data)
+            else:
+                await doc_ref.set(request_data)
             logger.info(f"Created PR request: {request_id}")
             return True
 
@@ -145,7 +218,7 @@ class StateManager:
             logger.error(f"Error creating PR request: {e}", exc_info=True)
             return False
 
-    def update_pr_request_status(
+    async def update_pr_request_status(
         self,
         request_id: str,
         status: str,
@@ -158,7 +231,7 @@ class StateManager:
             
             update_data = {
                 "status": status,
-                "updated_at": datetime.utcnow(),
+                "updated_at": firestore.SERVER_TIMESTAMP,
             }
             
             if pr_url:
@@ -166,7 +239,9 @@ class StateManager:
             if error:
                 update_data["error"] = error
             
-            doc_ref.update(update_data)
+            await doc_ref.update(update_data)
+            # Drop any cached copy so the new status propagates immediately
+            self._pr_cache.pop(request_id, None)
             logger.info(f"Updated PR request {request_id} to status: {status}")
             return True
 
@@ -174,14 +249,20 @@ class StateManager:
             logger.error(f"Error updating PR request status: {e}", exc_info=True)
             return False
 
-    def get_pr_request(self, request_id: str) -> Optional[Dict[str, Any]]:
+    async def get_pr_request(self, request_id: str) -> Optional[Dict[str, Any]]:
         """Get PR request details."""
         try:
+            cached = self._pr_cache.get(request_id)
+            if cached is not None:
+                return cached
+
             doc_ref = self.requests_collection.document(request_id)
-            doc = doc_ref.get()
-            
+            doc = await doc_ref.get()
+
             if doc.exists:
-                return doc.to_dict()
+                pr_request = doc.to_dict()
+                self._pr_cache[request_id] = pr_request
+                return pr_request
             return None
 
         except Exception as e:
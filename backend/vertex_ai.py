@@ -2,8 +2,9 @@
 Vertex AI integration for entity extraction using Gemini with Function Calling.
 """
 import os
-import json
+import asyncio
 import logging
+import re
 from typing import Dict, Optional, Any
 import vertexai
 from vertexai.preview.generative_models import (
@@ -20,6 +21,12 @@ PROJECT_ID = os.getenv("PROJECT_ID", "helpful-charmer-485315-j7")
 LOCATION = os.getenv("LOCATION", "us-central1")
 MODEL_NAME = os.getenv("VERTEX_AI_MODEL", "gemini-2.5-pro")
 
+# Budgets for the prompt's history section. Capping by bytes rather than
+# message count keeps one large paste from being re-sent to Gemini (and
+# re-billed) on every subsequent turn of the session.
+HISTORY_BYTES_BUDGET = int(os.getenv("HISTORY_BYTES_BUDGET", "4096"))
+HISTORY_MSG_BYTES = int(os.getenv("HISTORY_MSG_BYTES", "512"))
+
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 
 
@@ -53,6 +60,62 @@ extract_dataset_function = FunctionDeclaration(
 dataset_extraction_tool = Tool(function_declarations=[extract_dataset_function])
 
 
+# Cheap per-field extractors used to answer a turn without a Gemini
+# round-trip when nearly everything has already been collected and the user
+# is likely just supplying the one remaining value. Only well-anchored
+# shapes are matched: a loose pattern that fires on ordinary prose ("yes
+# create it", "call it sales_data") would silently file a wrong PR, so
+# anything conversational must fall through to the model.
+_LOCAL_PATTERNS = {
+    "service_account": re.compile(r"\b[\w.+-]+@[\w.-]+\.iam\.gserviceaccount\.com\b"),
+    # Full region tokens only (us-east1, asia-northeast1). Bare prefixes
+    # like "us" or "me" collide with English words.
+    "location": re.compile(
+        r"\b(?:us|eu|asia|me|africa|southamerica|australia|northamerica)"
+        r"-[a-z]+\d\b",
+        re.IGNORECASE,
+    ),
+    "labels": re.compile(r"[\w-]+\s*[:=]\s*[^,\s]+(?:\s*,\s*[\w-]+\s*[:=]\s*[^,\s]+)*"),
+    # The whole message must be just the identifier (optionally quoted);
+    # any surrounding sentence goes to the model instead
+    "dataset_name": re.compile(r"\A\s*[\"'`]?([a-z][a-z0-9_]{2,})[\"'`]?\s*\Z"),
+}
+
+
+def local_extract(user_message: str, missing_fields: list) -> Dict[str, str]:
+    """
+    Attempt regex-only extraction of the given missing fields.
+
+    Returns a dict with whatever could be extracted; callers should fall
+    back to the model when the missing set isn't fully covered.
+    """
+    entities = {}
+    for field in missing_fields:
+        pattern = _LOCAL_PATTERNS.get(field)
+        if pattern is None:
+            continue
+        match = pattern.search(user_message)
+        if match:
+            entities[field] = match.group(1) if match.groups() else match.group(0)
+    return entities
+
+
+# Static instruction block shared by every extraction prompt. Kept as one
+# module-level constant so repeat calls send a byte-identical prefix, which
+# is what lets the server reuse its cached prompt prefix across turns.
+_PROMPT_PREFIX = """You are a helpful assistant that extracts BigQuery dataset creation parameters from user messages.
+
+Extract the following information:
+1. dataset_name: The name of the dataset (lowercase letters, numbers, underscores only)
+2. location: GCP region (e.g., us-central1, EU, asia-northeast1)
+3. labels: Key-value pairs for labeling (format: "key:value" or "key=value")
+4. service_account: Service account email for dataset ownership
+
+Only extract fields that are explicitly mentioned. Leave fields empty if not provided.
+
+"""
+
+
 class VertexAIExtractor:
     """Handles entity extraction using Vertex AI Gemini."""
 
@@ -68,7 +131,17 @@ class VertexAIExtractor:
             max_output_tokens=1024,
         )
 
-    def extract_entities(
+    async def warmup(self):
+        """
+        Pay the model's one-time lazy setup cost (auth, endpoint discovery,
+        gRPC channel) up front instead of on the first user request.
+        """
+        await self.model.generate_content_async(
+            "ping",
+            generation_config=GenerationConfig(max_output_tokens=1),
+        )
+
+    async def extract_entities(
         self, user_message: str, conversation_history: list = None
     ) -> Dict[str, Any]:
         """
@@ -87,8 +160,9 @@ class VertexAIExtractor:
 
             logger.info(f"Sending prompt to Vertex AI: {prompt[:200]}...")
 
-            # Generate response with function calling
-            response = self.model.generate_content(
+            # Generate response with function calling (async so the event
+            # loop keeps serving other requests during the round-trip)
+            response = await self.model.generate_content_async(
                 prompt,
                 generation_config=self.generation_config,
             )
@@ -109,29 +183,32 @@ class VertexAIExtractor:
 
     def _build_prompt(self, user_message: str, conversation_history: list = None) -> str:
         """Build a contextualized prompt for entity extraction."""
-        context = """You are a helpful assistant that extracts BigQuery dataset creation parameters from user messages.
-
-Extract the following information:
-1. dataset_name: The name of the dataset (lowercase letters, numbers, underscores only)
-2. location: GCP region (e.g., us-central1, EU, asia-northeast1)
-3. labels: Key-value pairs for labeling (format: "key:value" or "key=value")
-4. service_account: Service account email for dataset ownership
+        parts = [_PROMPT_PREFIX]
 
-Only extract fields that are explicitly mentioned. Leave fields empty if not provided.
-
-"""
         if conversation_history:
-            context += "\n**Previous conversation:**\n"
-            for msg in conversation_history[-5:]:  # Last 5 messages for context
+            # Walk backwards from the most recent message, truncating long
+            # messages and stopping once the byte budget is spent
+            selected = []
+            total_bytes = 0
+            for msg in reversed(conversation_history):
                 role = msg.get("role", "user")
                 content = msg.get("content", "")
-                context += f"{role.upper()}: {content}\n"
-            context += "\n"
+                if len(content) > HISTORY_MSG_BYTES:
+                    content = content[:HISTORY_MSG_BYTES] + "…"
+                line = f"{role.upper()}: {content}\n"
+                if selected and total_bytes + len(line) > HISTORY_BYTES_BUDGET:
+                    break
+                selected.append(line)
+                total_bytes += len(line)
 
-        context += f"**Current user message:**\n{user_message}\n\n"
-        context += "Extract all available dataset parameters from the conversation."
+            parts.append("\n**Previous conversation:**\n")
+            parts.extend(reversed(selected))
+            parts.append("\n")
 
-        return context
+        parts.append(f"**Current user message:**\n{user_message}\n\n")
+        parts.append("Extract all available dataset parameters from the conversation.")
+
+        return "".join(parts)
 
     def _parse_response(self, response) -> Dict[str, Any]:
         """Parse Vertex AI response and extract function call arguments."""
@@ -145,26 +222,27 @@ Only extract fields that are explicitly mentioned. Leave fields empty if not pro
                 }
 
             candidate = response.candidates[0]
-            
-            # Check if there's a function call
-            if candidate.content.parts:
-                for part in candidate.content.parts:
-                    if hasattr(part, "function_call") and part.function_call:
-                        function_call = part.function_call
-                        if function_call.name == "extract_dataset_info":
-                            # Extract the arguments
-                            entities = {}
-                            for key, value in function_call.args.items():
-                                entities[key] = value
-
-                            return {
-                                "success": True,
-                                "entities": entities,
-                            }
-
-            # If no function call, try to extract from text
-            if candidate.content.parts and candidate.content.parts[0].text:
-                text_response = candidate.content.parts[0].text
+
+            # Single pass over parts: record the first function call and the
+            # first text, then decide once at the end
+            function_call = None
+            text_response = None
+            for part in candidate.content.parts or ():
+                if function_call is None:
+                    function_call = getattr(part, "function_call", None) or None
+                if text_response is None:
+                    text_response = getattr(part, "text", None) or None
+                if function_call is not None and text_response is not None:
+                    break
+
+            if function_call is not None and function_call.name == "extract_dataset_info":
+                return {
+                    "success": True,
+                    "entities": dict(function_call.args),
+                }
+
+            # If no function call, fall back to the text response
+            if text_response:
                 logger.warning(
                     f"No function call in response, got text: {text_response}"
                 )
@@ -206,3 +284,96 @@ Only extract fields that are explicitly mentioned. Leave fields empty if not pro
         return "I still need the following information:\n" + "\n".join(
             f"• {q}" for q in questions
         )
+
+
+class BatchingExtractor:
+    """
+    Micro-batches concurrent extract_entities calls.
+
+    Calls arriving within a short window are collected off an asyncio.Queue
+    by a background worker and dispatched together, amortizing per-call
+    scheduling overhead and overlapping the Vertex AI round-trips. The
+    trade-off is up to one batch window of added latency per request, which
+    breaks even as soon as two users chat concurrently.
+
+    The Vertex SDK has no API for fusing independent function-calling
+    prompts into one request, so a collected batch is fired as concurrent
+    generate_content_async calls rather than a single fused call.
+    """
+
+    def __init__(self, extractor: VertexAIExtractor):
+        self.extractor = extractor
+        self.max_batch = int(os.getenv("EXTRACTION_MAX_BATCH", "8"))
+        self.batch_window = float(os.getenv("EXTRACTION_BATCH_WINDOW", "0.025"))
+        self._queue = asyncio.Queue()
+        self._worker_task = None
+        # Strong refs to in-flight dispatch tasks (asyncio only keeps weak ones)
+        self._inflight = set()
+
+    async def extract_entities(
+        self, user_message: str, conversation_history: list = None
+    ) -> Dict[str, Any]:
+        """Queue an extraction and wait for the batched result."""
+        loop = asyncio.get_running_loop()
+        if self._worker_task is None:
+            self._worker_task = loop.create_task(self._worker())
+
+        future = loop.create_future()
+        await self._queue.put((user_message, conversation_history, future))
+        return await future
+
+    def generate_follow_up_question(self, missing_fields: list) -> str:
+        """Delegate to the wrapped extractor (pure string templating)."""
+        return self.extractor.generate_follow_up_question(missing_fields)
+
+    async def warmup(self):
+        """Delegate to the wrapped extractor."""
+        await self.extractor.warmup()
+
+    async def _worker(self):
+        """Drain the queue in micro-batches and dispatch each batch at once."""
+        while True:
+            pending = [await self._queue.get()]
+
+            # Collect whatever else arrives inside the batch window
+            while len(pending) < self.max_batch:
+                try:
+                    pending.append(
+                        await asyncio.wait_for(
+                            self._queue.get(), timeout=self.batch_window
+                        )
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            if len(pending) > 1:
+                logger.info(f"Dispatching extraction batch of {len(pending)}")
+
+            # Fire the batch without awaiting it: awaiting here would make
+            # every new request wait for the slowest call of the previous
+            # batch before its own dispatch even starts
+            task = asyncio.create_task(self._dispatch(pending))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, pending):
+        """Run one collected batch concurrently and fulfil its futures."""
+        results = await asyncio.gather(
+            *(
+                self.extractor.extract_entities(message, history)
+                for message, history, _ in pending
+            ),
+            return_exceptions=True,
+        )
+
+        for (_, _, future), result in zip(pending, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, BaseException):
+                future.set_result({
+                    "success": False,
+                    "error": str(result),
+                    "entities": {},
+                })
+            else:
+                future.set_result(result)
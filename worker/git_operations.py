@@ -4,33 +4,136 @@ Git operations for cloning, branching, committing, and pushing.
 import os
 import logging
 import shutil
+import subprocess
+import threading
 from pathlib import Path
 from git import Repo, GitCommandError
 
 logger = logging.getLogger(__name__)
 
+# Identity for commits created by the worker. commit-tree (unlike GitPython's
+# index.commit) hard-fails when no user.name/user.email is configured, and
+# the worker image ships with none.
+GIT_USER_NAME = os.getenv("GIT_USER_NAME", "git-worker")
+GIT_USER_EMAIL = os.getenv("GIT_USER_EMAIL", "git-worker@noreply.github.com")
+
 
 class GitOperations:
     """Handles all Git operations for the worker."""
 
-    def __init__(self, repo_url: str, work_dir: str = "/tmp/git-workspace"):
+    # Credential-helper setup is global git config; do it once per process
+    _credentials_configured = False
+
+    # Serializes clone/fetch of the shared bare object store; worktrees on
+    # top of it are independent and need no locking
+    _bare_lock = threading.Lock()
+
+    @classmethod
+    def configure_credentials(cls, token: str) -> bool:
+        """
+        Register the GitHub token with git's in-memory credential cache.
+
+        Keeps the token out of remote URLs and .git/config (where the old
+        https://TOKEN@ rewriting leaked it) and lets every subsequent
+        fetch/push authenticate without touching the remote config.
+        """
+        if cls._credentials_configured:
+            return True
+
+        try:
+            subprocess.run(
+                ["git", "config", "--global", "credential.helper", "cache --timeout=7200"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            subprocess.run(
+                ["git", "credential", "approve"],
+                input=(
+                    "protocol=https\n"
+                    "host=github.com\n"
+                    "username=x-access-token\n"
+                    f"password={token}\n\n"
+                ),
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            cls._credentials_configured = True
+            return True
+
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error configuring git credentials: {e.stderr}", exc_info=True)
+            return False
+
+    def __init__(
+        self,
+        repo_url: str,
+        work_dir: str = "/tmp/git-workspace",
+        bare_dir: str = "/tmp/git-workspace/repo.git",
+    ):
         """
         Initialize Git operations.
 
         Args:
             repo_url: Git repository URL (HTTPS with token or SSH)
-            work_dir: Local directory for Git operations
+            work_dir: Local directory for this message's worktree
+            bare_dir: Shared bare clone holding the object database
         """
         self.repo_url = repo_url
         self.work_dir = Path(work_dir)
+        self.bare_dir = Path(bare_dir)
         self.repo = None
-        
+
         # Ensure work directory exists
         self.work_dir.mkdir(parents=True, exist_ok=True)
 
+    def _run_git(self, *args: str) -> str:
+        """
+        Run a git command against the working tree in one subprocess.
+
+        GitPython's porcelain wrappers (index.add, index.commit, push, ...)
+        each spawn git several times and re-parse config; a single exec with
+        shared flags keeps the hot commit/push path to one process per step.
+        """
+        result = subprocess.run(
+            [
+                "git",
+                "-C", str(self.work_dir / "repo"),
+                "-c", "protocol.version=2",
+                "-c", "gc.auto=0",
+                *args,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stdout
+
+    def _run_bare_git(self, *args: str) -> str:
+        """Run a git command against the shared bare object store."""
+        result = subprocess.run(
+            [
+                "git",
+                "--git-dir", str(self.bare_dir),
+                "-c", "protocol.version=2",
+                "-c", "gc.auto=0",
+                *args,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stdout
+
     def clone_or_update(self, token: str = None) -> bool:
         """
-        Clone repository if not exists, otherwise pull latest changes.
+        Prepare this message's worktree on top of the shared bare clone.
+
+        The bare clone is made once per container and refreshed with a
+        shallow fetch; each message then gets a `git worktree` that shares
+        the object database, so concurrent messages never re-download or
+        re-checkout the whole repository.
 
         Args:
             token: GitHub Personal Access Token for authentication
@@ -41,35 +144,85 @@ class GitOperations:
         try:
             repo_path = self.work_dir / "repo"
 
-            # Add token to URL if provided
-            if token and self.repo_url.startswith("https://"):
-                # Format: https://TOKEN@github.com/owner/repo.git
-                auth_url = self.repo_url.replace("https://", f"https://{token}@")
-            else:
-                auth_url = self.repo_url
+            # Authenticate via the credential cache instead of embedding the
+            # token in the remote URL
+            if token:
+                self.configure_credentials(token)
+
+            default_branch = os.getenv("GITHUB_DEFAULT_BRANCH", "main")
+
+            with GitOperations._bare_lock:
+                if self.bare_dir.exists():
+                    # ls-remote is a refs-only round-trip (no pack
+                    # negotiation); when the remote tip hasn't moved the
+                    # fetch can be skipped outright
+                    remote_out = self._run_bare_git(
+                        "ls-remote", "origin", f"refs/heads/{default_branch}"
+                    )
+                    remote_sha = remote_out.split()[0] if remote_out.strip() else None
+                    local_sha = self._run_bare_git("rev-parse", default_branch).strip()
+
+                    if remote_sha and remote_sha == local_sha:
+                        logger.info("Repository already at remote tip, skipping fetch")
+                    else:
+                        logger.info("Bare repository exists, fetching latest changes...")
+                        self._run_bare_git(
+                            "fetch", "--depth=1", "origin",
+                            f"+{default_branch}:{default_branch}",
+                        )
+                else:
+                    logger.info(f"Cloning bare repository from {self.repo_url}...")
+                    # The worker only adds one file and pushes a branch, so
+                    # skip history, tags, other branches, and unneeded blobs
+                    subprocess.run(
+                        [
+                            "git", "clone",
+                            "--bare",
+                            "--depth=1",
+                            "--single-branch",
+                            "--no-tags",
+                            "--filter=blob:none",
+                            f"--branch={default_branch}",
+                            self.repo_url,
+                            str(self.bare_dir),
+                        ],
+                        capture_output=True,
+                        text=True,
+                        check=True,
+                    )
+                    logger.info("Successfully cloned bare repository")
 
+            # A redelivered message reuses the same per-request path, so
+            # clear any worktree a failed earlier attempt left behind -
+            # 'worktree add' refuses to reuse an existing directory
             if repo_path.exists():
-                logger.info("Repository exists, pulling latest changes...")
-                self.repo = Repo(repo_path)
-                
-                # Checkout main branch and pull
-                self.repo.git.checkout(os.getenv("GITHUB_DEFAULT_BRANCH", "main"))
-                origin = self.repo.remotes.origin
-                origin.pull()
-                
-                logger.info("Successfully updated repository")
-            else:
-                logger.info(f"Cloning repository from {self.repo_url}...")
-                self.repo = Repo.clone_from(auth_url, repo_path)
-                logger.info("Successfully cloned repository")
+                try:
+                    self._run_bare_git(
+                        "worktree", "remove", "--force", str(repo_path)
+                    )
+                except subprocess.CalledProcessError:
+                    # Directory exists but isn't a registered worktree
+                    # (e.g. a half-finished add); drop both sides manually
+                    self._run_bare_git("worktree", "prune")
+                    shutil.rmtree(repo_path, ignore_errors=True)
+
+            # Detached so parallel worktrees never contend for a branch ref;
+            # create_branch gives the worktree its own branch right after
+            self._run_bare_git(
+                "worktree", "add", "--detach", str(repo_path), default_branch
+            )
+            self.repo = Repo(repo_path)
 
             return True
 
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Git command error: {e.stderr}", exc_info=True)
+            return False
         except GitCommandError as e:
             logger.error(f"Git command error: {e}", exc_info=True)
             return False
         except Exception as e:
-            logger.error(f"Error cloning/updating repository: {e}", exc_info=True)
+            logger.error(f"Error preparing workspace: {e}", exc_info=True)
             return False
 
     def create_branch(self, branch_name: str) -> bool:
@@ -88,12 +241,14 @@ class GitOperations:
                 return False
 
             # Create and checkout new branch
-            new_branch = self.repo.create_head(branch_name)
-            new_branch.checkout()
-            
+            self._run_git("checkout", "-b", branch_name)
+
             logger.info(f"Created and checked out branch: {branch_name}")
             return True
 
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error creating branch: {e.stderr}", exc_info=True)
+            return False
         except Exception as e:
             logger.error(f"Error creating branch: {e}", exc_info=True)
             return False
@@ -114,15 +269,29 @@ class GitOperations:
                 logger.error("Repository not initialized")
                 return False
 
-            # Stage the file
-            self.repo.index.add([file_path])
-            
-            # Commit
-            self.repo.index.commit(commit_message)
-            
+            # The worker only ever commits the one generated file, so use
+            # plumbing directly: no working-tree status walk, no ignore
+            # matching, no hook machinery - just blob, tree, commit, ref
+            blob_sha = self._run_git("hash-object", "-w", "--", file_path).strip()
+            self._run_git(
+                "update-index", "--add", "--cacheinfo",
+                f"100644,{blob_sha},{file_path}",
+            )
+            tree_sha = self._run_git("write-tree").strip()
+            parent_sha = self._run_git("rev-parse", "HEAD").strip()
+            commit_sha = self._run_git(
+                "-c", f"user.name={GIT_USER_NAME}",
+                "-c", f"user.email={GIT_USER_EMAIL}",
+                "commit-tree", tree_sha, "-p", parent_sha, "-m", commit_message,
+            ).strip()
+            self._run_git("update-ref", "HEAD", commit_sha)
+
             logger.info(f"Committed changes to {file_path}")
             return True
 
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error committing changes: {e.stderr}", exc_info=True)
+            return False
         except Exception as e:
             logger.error(f"Error committing changes: {e}", exc_info=True)
             return False
@@ -143,19 +312,20 @@ class GitOperations:
                 logger.error("Repository not initialized")
                 return False
 
-            # Configure remote with token if provided
+            # The credential cache (set up during clone) covers pushes too;
+            # re-approve here in case push is called on a pre-existing clone
             if token:
-                origin = self.repo.remotes.origin
-                auth_url = self.repo_url.replace("https://", f"https://{token}@")
-                origin.set_url(auth_url)
+                self.configure_credentials(token)
 
             # Push the branch
-            origin = self.repo.remotes.origin
-            origin.push(branch_name)
-            
+            self._run_git("push", "-u", "origin", branch_name)
+
             logger.info(f"Successfully pushed branch: {branch_name}")
             return True
 
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error pushing branch: {e.stderr}", exc_info=True)
+            return False
         except Exception as e:
             logger.error(f"Error pushing branch: {e}", exc_info=True)
             return False
@@ -164,11 +334,29 @@ class GitOperations:
         """Get the path to the local repository."""
         return self.work_dir / "repo"
 
-    def cleanup(self):
-        """Clean up the workspace."""
+    def cleanup(self, branch_name: str = None):
+        """
+        Remove this message's worktree and its pushed branch.
+
+        The shared bare clone (and its object database) is kept for the
+        next message.
+        """
         try:
+            repo_path = self.work_dir / "repo"
+            if repo_path.exists():
+                # Untracked leftovers would make 'worktree remove' balk even
+                # with --force on locked files; sweep them with git first so
+                # deletion never falls back to a slow Python-side rmtree
+                self._run_git("reset", "--hard", "--quiet")
+                self._run_git("clean", "-xdfq")
+                self._run_bare_git("worktree", "remove", "--force", str(repo_path))
+            if branch_name:
+                self._run_bare_git("branch", "-D", branch_name)
             if self.work_dir.exists():
-                shutil.rmtree(self.work_dir)
-                logger.info("Cleaned up workspace")
+                # Only the now-empty per-request directory remains
+                self.work_dir.rmdir()
+            logger.info("Cleaned up workspace")
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error cleaning up: {e.stderr}", exc_info=True)
         except Exception as e:
             logger.error(f"Error cleaning up: {e}", exc_info=True)
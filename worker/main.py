@@ -3,10 +3,16 @@ Worker job that pulls Pub/Sub messages and creates PRs.
 Cloud Run Job pattern - pulls messages and processes until queue is empty.
 """
 import os
-import json
+import functools
+import itertools
 import logging
+import threading
+import uuid
+from concurrent import futures
 from datetime import datetime
 from pathlib import Path
+import orjson
+from google.api_core.client_options import ClientOptions
 from google.cloud import pubsub_v1, secretmanager, firestore
 from dotenv import load_dotenv
 
@@ -32,6 +38,45 @@ GITHUB_REPO_URL = os.getenv("GITHUB_REPO_URL", "https://github.com/AmeerHossam/C
 GITHUB_REPO_OWNER = os.getenv("GITHUB_REPO_OWNER", "AmeerHossam")
 GITHUB_REPO_NAME = os.getenv("GITHUB_REPO_NAME", "Chatbot")
 TERRAFORM_DIR = os.getenv("TERRAFORM_FILES_DIRECTORY", "datasets")
+MAX_CONCURRENT_MESSAGES = int(os.getenv("MAX_CONCURRENT_MESSAGES", "10"))
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", "300"))
+STATUS_FLUSH_INTERVAL = float(os.getenv("STATUS_FLUSH_INTERVAL", "1.0"))
+
+# Commit message template, built once at import instead of re-assembled
+# as an f-string on every processed message
+_COMMIT_TMPL = """feat: Add BigQuery dataset {dataset_name}
+
+Created via AI Chatbot
+- Location: {location}
+- Labels: {labels}
+- Owner: {service_account}
+
+Request ID: {request_id}
+"""
+
+# Per-process counter plus a random component keeps branch names unique
+# even when several messages for the same dataset land within one second
+# (int(time.time()) suffixes collided under concurrency)
+_COUNTER = itertools.count()
+
+# Shared at module scope so a warm container reuses the connection pool
+# across job invocations
+firestore_client = firestore.Client(project=PROJECT_ID)
+
+
+@functools.lru_cache(maxsize=4)
+def get_secret(secret_name: str) -> str:
+    """Fetch a secret from Secret Manager (memoized per process)."""
+    try:
+        client = secretmanager.SecretManagerServiceClient()
+        name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest"
+        response = client.access_secret_version(request={"name": name})
+        secret_value = response.payload.data.decode("UTF-8")
+        logger.info(f"Successfully retrieved secret: {secret_name}")
+        return secret_value
+    except Exception as e:
+        logger.error(f"Error fetching secret {secret_name}: {e}", exc_info=True)
+        raise
 
 
 class Worker:
@@ -39,52 +84,95 @@ class Worker:
 
     def __init__(self):
         """Initialize worker with all necessary clients."""
-        # Initialize clients
-        self.subscriber = pubsub_v1.SubscriberClient()
-        self.secret_client = secretmanager.SecretManagerServiceClient()
-        self.firestore_client = firestore.Client(project=PROJECT_ID)
-        
-        # Get GitHub token from Secret Manager
-        self.github_token = self._get_secret(GITHUB_TOKEN_SECRET)
-        
+        # Initialize clients. When PUBSUB_REGION is set, talk to the
+        # regional Pub/Sub endpoint colocated with the job instead of the
+        # global one - shorter round-trips on every stream operation
+        pubsub_region = os.getenv("PUBSUB_REGION")
+        if pubsub_region:
+            self.subscriber = pubsub_v1.SubscriberClient(
+                client_options=ClientOptions(
+                    api_endpoint=f"{pubsub_region}-pubsub.googleapis.com:443"
+                )
+            )
+        else:
+            self.subscriber = pubsub_v1.SubscriberClient()
+        self.firestore_client = firestore_client
+
+        # Get GitHub token from Secret Manager (memoized across Workers)
+        self.github_token = get_secret(GITHUB_TOKEN_SECRET)
+
         # Subscription path
         self.subscription_path = self.subscriber.subscription_path(
             PROJECT_ID, SUBSCRIPTION_NAME
         )
 
-    def _get_secret(self, secret_name: str) -> str:
-        """Fetch secret from Secret Manager."""
-        try:
-            name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest"
-            response = self.secret_client.access_secret_version(request={"name": name})
-            secret_value = response.payload.data.decode("UTF-8")
-            logger.info(f"Successfully retrieved secret: {secret_name}")
-            return secret_value
-        except Exception as e:
-            logger.error(f"Error fetching secret {secret_name}: {e}", exc_info=True)
-            raise
+        # Non-final status writes are collected here (messages are processed
+        # on a thread pool, hence the lock) and flushed periodically in one
+        # Firestore batch instead of one round-trip each
+        self._pending_status_updates = []
+        self._status_lock = threading.Lock()
+
+        # Default branch is stable for the repo's lifetime; resolve it once
+        self._default_branch = None
 
-    def _update_request_status(self, request_id: str, status: str, pr_url: str = None, error: str = None):
-        """Update request status in Firestore."""
+    def _update_request_status(self, request_id: str, status: str, pr_url: str = None, error: str = None, wait: bool = True):
+        """
+        Update request status in Firestore.
+
+        Intermediate statuses (e.g. "processing") can pass wait=False to
+        queue the write for the next batched flush and keep the message
+        path moving; terminal statuses should block so the outcome is
+        durable before the message is acked.
+        """
         try:
             doc_ref = self.firestore_client.collection("pr_requests").document(request_id)
-            
+
             update_data = {
                 "status": status,
                 "updated_at": datetime.utcnow(),
             }
-            
+
             if pr_url:
                 update_data["pr_url"] = pr_url
             if error:
                 update_data["error"] = error
-            
-            doc_ref.update(update_data)
+
+            if wait:
+                # Drop any queued intermediate write for this request so a
+                # later flush can't clobber the terminal status
+                with self._status_lock:
+                    self._pending_status_updates = [
+                        (ref, data)
+                        for ref, data in self._pending_status_updates
+                        if ref.id != request_id
+                    ]
+                doc_ref.update(update_data)
+            else:
+                with self._status_lock:
+                    self._pending_status_updates.append((doc_ref, update_data))
             logger.info(f"Updated request {request_id} status to: {status}")
-            
+
         except Exception as e:
             logger.error(f"Error updating request status: {e}", exc_info=True)
 
+    def _flush_status_updates(self):
+        """Commit any queued non-final status writes in a single batch."""
+        with self._status_lock:
+            pending = self._pending_status_updates
+            self._pending_status_updates = []
+
+        if not pending:
+            return
+
+        try:
+            batch = self.firestore_client.batch()
+            for doc_ref, update_data in pending:
+                batch.update(doc_ref, update_data)
+            batch.commit()
+            logger.info(f"Flushed {len(pending)} batched status update(s)")
+        except Exception as e:
+            logger.error(f"Error flushing status updates: {e}", exc_info=True)
+
     def process_message_data(self, data: dict):
         """Process a single dataset request from message data."""
         request_id = data.get("request_id")
@@ -99,11 +187,16 @@ class Worker:
         if not all([request_id, dataset_name, location, service_account]):
             raise ValueError(f"Missing required fields in request: {data}")
 
-        # Update status to processing
-        self._update_request_status(request_id, "processing")
+        # Update status to processing (non-blocking - not worth a round-trip
+        # on the hot path)
+        self._update_request_status(request_id, "processing", wait=False)
 
-        # Initialize helper classes
-        git_ops = GitOperations(repo_url=GITHUB_REPO_URL)
+        # Initialize helper classes. Each message gets its own workspace so
+        # concurrently processed messages never mutate the same working tree
+        git_ops = GitOperations(
+            repo_url=GITHUB_REPO_URL,
+            work_dir=f"/tmp/git-workspace/{request_id}",
+        )
         terraform_gen = TerraformGenerator()
         github_api = GitHubAPI(
             token=self.github_token,
@@ -111,176 +204,203 @@ class Worker:
             repo_name=GITHUB_REPO_NAME,
         )
 
-        # Step 1: Clone/update repository
-        logger.info("Step 1: Cloning/updating repository...")
-        if not git_ops.clone_or_update(token=self.github_token):
-            raise Exception("Failed to clone/update repository")
+        branch_name = None
+        try:
+            # Step 1: Clone/update repository
+            logger.info("Step 1: Cloning/updating repository...")
+            if not git_ops.clone_or_update(token=self.github_token):
+                raise Exception("Failed to clone/update repository")
 
-        # Step 2: Create branch
-        import time
-        timestamp = int(time.time())
-        branch_name = f"dataset/{dataset_name}-{timestamp}"
-        logger.info(f"Step 2: Creating branch: {branch_name}")
-        
-        if not git_ops.create_branch(branch_name):
-            raise Exception(f"Failed to create branch: {branch_name}")
+            # Step 2: Create branch
+            suffix = f"{next(_COUNTER)}-{uuid.uuid4().hex[:8]}"
+            branch_name = f"dataset/{dataset_name}-{suffix}"
+            logger.info(f"Step 2: Creating branch: {branch_name}")
 
-        # Step 3: Generate Terraform file
-        logger.info("Step 3: Generating Terraform configuration...")
-        
-        # Parse labels if it's a string
-        if isinstance(labels, str):
-            label_dict = {}
-            if labels:
-                for item in labels.split(','):
-                    if ':' in item:
-                        key, value = item.split(':', 1)
-                        label_dict[key.strip()] = value.strip()
-            labels = label_dict
-        
-        terraform_content = terraform_gen.generate_bigquery_dataset(
-            dataset_name=dataset_name,
-            location=location,
-            labels=labels,
-            service_account=service_account,
-        )
+            if not git_ops.create_branch(branch_name):
+                raise Exception(f"Failed to create branch: {branch_name}")
 
-        # Step 4: Write file to repository
-        logger.info("Step 4: Writing Terraform file...")
-        repo_path = git_ops.get_repo_path()
-        terraform_dir = repo_path / TERRAFORM_DIR
-        
-        file_path = terraform_gen.write_to_file(
-            content=terraform_content,
-            target_dir=terraform_dir,
-            filename=f"{dataset_name}.tf",
-        )
-        
-        # Get relative path for git operations
-        relative_path = f"{TERRAFORM_DIR}/{dataset_name}.tf"
+            # Step 3: Generate Terraform file
+            logger.info("Step 3: Generating Terraform configuration...")
 
-        # Step 5: Commit changes
-        logger.info("Step 5: Committing changes...")
-        labels_str = ', '.join([f'{k}={v}' for k, v in labels.items()]) if labels else 'none'
-        commit_message = f"""feat: Add BigQuery dataset {dataset_name}
+            # Normalize labels (string form from extraction -> dict)
+            labels = TerraformGenerator.parse_labels(labels)
 
-Created via AI Chatbot
-- Location: {location}
-- Labels: {labels_str}
-- Owner: {service_account}
+            terraform_content = terraform_gen.generate_bigquery_dataset(
+                dataset_name=dataset_name,
+                location=location,
+                labels=labels,
+                service_account=service_account,
+            )
 
-Request ID: {request_id}
-"""
-        
-        if not git_ops.commit_changes(relative_path, commit_message):
-            raise Exception("Failed to commit changes")
-
-        # Step 6: Push branch
-        logger.info("Step 6: Pushing branch to remote...")
-        if not git_ops.push_branch(branch_name, token=self.github_token):
-            raise Exception("Failed to push branch")
-
-        # Step 7: Create Pull Request
-        logger.info("Step 7: Creating Pull Request...")
-        pr_title = f"Add BigQuery Dataset: {dataset_name}"
-        pr_body = github_api.format_pr_body(
-            dataset_name=dataset_name,
-            location=location,
-            labels=labels,
-            service_account=service_account,
-            request_id=request_id,
-        )
-        
-        pr_url = github_api.create_pull_request(
-            title=pr_title,
-            body=pr_body,
-            head_branch=branch_name,
-            base_branch=github_api.get_default_branch(),
-        )
+            # Step 4: Write file to repository
+            logger.info("Step 4: Writing Terraform file...")
+            repo_path = git_ops.get_repo_path()
+            terraform_dir = repo_path / TERRAFORM_DIR
 
-        if not pr_url:
-            raise Exception("Failed to create Pull Request")
+            file_path = terraform_gen.write_to_file(
+                content=terraform_content,
+                target_dir=terraform_dir,
+                filename=f"{dataset_name}.tf",
+            )
 
-        # Update status to completed
-        self._update_request_status(request_id, "completed", pr_url=pr_url)
-        
-        logger.info(f"✅ Successfully created PR: {pr_url}")
-        
-        # Cleanup
-        git_ops.cleanup()
+            # Get relative path for git operations
+            relative_path = f"{TERRAFORM_DIR}/{dataset_name}.tf"
 
-    def pull_and_process(self):
-        """Pull messages from subscription and process them."""
-        logger.info(f"Pulling messages from {self.subscription_path}...")
-        
-        try:
-            # Pull messages (max 10 at a time)
-            response = self.subscriber.pull(
-                request={
-                    "subscription": self.subscription_path,
-                    "max_messages": 10,
-                },
-                timeout=30,
+            # Step 5: Commit changes
+            logger.info("Step 5: Committing changes...")
+            labels_str = ', '.join(f'{k}={v}' for k, v in labels.items()) if labels else 'none'
+            commit_message = _COMMIT_TMPL.format(
+                dataset_name=dataset_name,
+                location=location,
+                labels=labels_str,
+                service_account=service_account,
+                request_id=request_id,
             )
-            
-            if not response.received_messages:
-                logger.info("No messages found in queue.")
-                return 0
-
-            logger.info(f"Received {len(response.received_messages)} message(s)")
-            
-            # Process each message
-            ack_ids = []
-            for received_message in response.received_messages:
-                try:
-                    # Decode message data
-                    data = json.loads(received_message.message.data.decode("utf-8"))
-                    
-                    # Process the request
-                    self.process_message_data(data)
-                    
-                    # Add to ack list if successful
-                    ack_ids.append(received_message.ack_id)
-                    
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}", exc_info=True)
-                    # Don't ack failed messages - they'll be retried
-                    
-            # Acknowledge successfully processed messages
-            if ack_ids:
-                self.subscriber.acknowledge(
-                    request={
-                        "subscription": self.subscription_path,
-                        "ack_ids": ack_ids,
-                    }
+
+
+            if not git_ops.commit_changes(relative_path, commit_message):
+                raise Exception("Failed to commit changes")
+
+            # Step 6: Push branch, resolving the PR base branch in parallel -
+            # both are independent network round-trips
+            logger.info("Step 6: Pushing branch to remote...")
+            with futures.ThreadPoolExecutor(max_workers=2) as pool:
+                push_future = pool.submit(
+                    git_ops.push_branch, branch_name, token=self.github_token
                 )
-                logger.info(f"Acknowledged {len(ack_ids)} message(s)")
-                
-            return len(ack_ids)
-            
+                base_future = pool.submit(self._get_default_branch, github_api)
+                pushed = push_future.result()
+                base_branch = base_future.result()
+
+            if not pushed:
+                raise Exception("Failed to push branch")
+
+            # Step 7: Create Pull Request
+            logger.info("Step 7: Creating Pull Request...")
+            pr_title = f"Add BigQuery Dataset: {dataset_name}"
+            pr_body = github_api.format_pr_body(
+                dataset_name=dataset_name,
+                location=location,
+                labels=labels,
+                service_account=service_account,
+                request_id=request_id,
+            )
+
+            pr_url = github_api.create_pull_request(
+                title=pr_title,
+                body=pr_body,
+                head_branch=branch_name,
+                base_branch=base_branch,
+            )
+
+            if not pr_url:
+                raise Exception("Failed to create Pull Request")
+
+            # Update status to completed
+            self._update_request_status(request_id, "completed", pr_url=pr_url)
+
+            logger.info(f"✅ Successfully created PR: {pr_url}")
+
+        finally:
+            # Always release the worktree - a redelivered message
+            # reuses the same per-request path, and 'worktree add'
+            # fails if a stale one lingers after an error
+            git_ops.cleanup(branch_name=branch_name)
+
+    def _get_default_branch(self, github_api: GitHubAPI) -> str:
+        """
+        Resolve the repository's default branch, cached per worker.
+
+        Prefers the GITHUB_DEFAULT_BRANCH env var; otherwise asks the
+        GitHub API once and reuses the answer for every later message.
+        """
+        if self._default_branch is None:
+            self._default_branch = (
+                os.getenv("GITHUB_DEFAULT_BRANCH") or github_api.get_default_branch()
+            )
+        return self._default_branch
+
+    def _on_message(self, message):
+        """
+        Streaming-pull callback: runs on the subscriber's thread pool, one
+        invocation per message. The client library manages lease extension
+        while we work, so no manual modify_ack_deadline is needed.
+        """
+        try:
+            # Decode message data (orjson takes the raw bytes directly)
+            data = orjson.loads(message.data)
+
+            # Process the request
+            self.process_message_data(data)
+
+            message.ack()
+            with self._status_lock:
+                self._processed_count += 1
+
+        except Exception as e:
+            logger.error(f"Error processing message: {e}", exc_info=True)
+            # Nack failed messages - they'll be redelivered
+            message.nack()
+
+    def run(self) -> int:
+        """
+        Stream messages from the subscription until the job timeout.
+
+        Streaming pull starts delivering messages as soon as they exist
+        instead of waiting for the next pull round-trip, and flow control
+        caps how many are processed concurrently.
+        """
+        self._processed_count = 0
+
+        # Flush queued intermediate writes on a short cadence while the
+        # stream runs - "processing" should be visible while a message is
+        # actually processing, not land stale at job shutdown
+        stop_flushing = threading.Event()
+
+        def _flush_loop():
+            while not stop_flushing.wait(STATUS_FLUSH_INTERVAL):
+                self._flush_status_updates()
+
+        flusher = threading.Thread(target=_flush_loop, daemon=True)
+        flusher.start()
+
+        flow_control = pubsub_v1.types.FlowControl(
+            max_messages=MAX_CONCURRENT_MESSAGES,
+        )
+        streaming_pull_future = self.subscriber.subscribe(
+            self.subscription_path,
+            callback=self._on_message,
+            flow_control=flow_control,
+        )
+        logger.info(f"Streaming messages from {self.subscription_path}...")
+
+        try:
+            streaming_pull_future.result(timeout=JOB_TIMEOUT_SECONDS)
+        except futures.TimeoutError:
+            logger.info("Job timeout reached, shutting down stream.")
         except Exception as e:
-            logger.error(f"Error in pull operation: {e}", exc_info=True)
-            return 0
+            logger.error(f"Error in streaming pull: {e}", exc_info=True)
+        finally:
+            streaming_pull_future.cancel()
+            try:
+                # Wait for the stream to wind down; if it died with an
+                # error it was already logged above - don't let result()
+                # re-raise it and skip the flush
+                streaming_pull_future.result()
+            except Exception:
+                pass
+            stop_flushing.set()
+            flusher.join()
+            # Make sure any last queued writes land before exiting
+            self._flush_status_updates()
+
+        return self._processed_count
 
 
 if __name__ == "__main__":
     logger.info("🚀 Starting Cloud Run Job - Git Worker")
-    
+
     worker = Worker()
-    
-    # Process messages in a loop until queue is empty or timeout
-    # Cloud Run Jobs have a max execution time, so we process what we can
-    total_processed = 0
-    max_iterations = 10  # Prevent infinite loops
-    
-    for iteration in range(max_iterations):
-        logger.info(f"Iteration {iteration + 1}/{max_iterations}")
-        
-        processed = worker.pull_and_process()
-        total_processed += processed
-        
-        if processed == 0:
-            logger.info("No more messages to process. Job complete.")
-            break
-    
+    total_processed = worker.run()
+
     logger.info(f"✅ Job execution completed. Processed {total_processed} message(s).")